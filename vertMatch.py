@@ -11,71 +11,241 @@
 # ----------------------------------------------------------------------------------------------------------------------
 
 from maya.api import OpenMaya as om2
+import numpy as np
 import sys
 
+try:
+	from scipy.spatial import cKDTree
+except ImportError:
+	cKDTree = None
+
+try:
+	from numba import njit, prange
+	HAS_NUMBA = True
+except ImportError:
+	HAS_NUMBA = False
+
+	# no numba so the fallback kd-tree runs as plain python
+	def njit(*args, **kwargs):
+		return lambda func: func
+
+	prange = range
+
+# below this many source verts a dense distance matrix beats the plain python kd-tree, it never beats
+# cKDTree or the numba tree so it is only used when neither is available
+BRUTE_FORCE_LIMIT = 20000
+
+# most query/source distances the dense path holds at once, queries are matched in chunks under this
+BRUTE_FORCE_CHUNK = 2 ** 22
+
+# most points a fallback kd-tree leaf holds, these get scanned rather than split further
+LEAFSIZE = 16
+
+# last source tree built, keyed by sourceKey() so repeat matches to the same verts skip the build
+_TREE_CACHE = {}
+
+
+def pointArray(points):
+	return np.array([(point.x, point.y, point.z) for point in points], dtype=np.float64).reshape(-1, 3)
+# end def pointArray():
 
-def buildKdTree(points, depth=0):
-	n = len(points)
 
-	if n <= 0:
-		return None
+def vertexIndices(MObComponent, num_verts):
+	# whole mesh is selected rather than components
+	if MObComponent.isNull():
+		return list(range(num_verts))
 
-	# split tree based on this axis
-	axis = depth % 3
+	return list(om2.MFnSingleIndexedComponent(MObComponent).getElements())
+# end def vertexIndices():
 
-	sorted_points = sorted(points, key=lambda point: point[axis])
 
-	return {
-		'point': sorted_points[n / 2],
-		'negative': buildKdTree(sorted_points[:n / 2], depth + 1),
-		'positive': buildKdTree(sorted_points[n / 2 + 1:], depth + 1)
-	}
+def selectedPoints(all_pts, indices):
+	# only convert the selected verts, not the whole mesh
+	return pointArray([all_pts[i] for i in indices])
+# end def selectedPoints():
+
+
+def vertexPositions(MDagMesh, MObComponent):
+	all_pts = om2.MFnMesh(MDagMesh).getPoints(om2.MSpace.kWorld)
+	return selectedPoints(all_pts, vertexIndices(MObComponent, len(all_pts)))
+# end def vertexPositions():
+
+
+def buildKdTree(points):
+	n = len(points)
+
+	# split down until each leaf holds at most LEAFSIZE points, a power of two leaves keeps the tree complete
+	num_leaves = 1
+	while num_leaves * LEAFSIZE < n:
+		num_leaves *= 2
+
+	# implicit tree in heap order, children of node i are 2i + 1 and 2i + 2. the first num_leaves - 1
+	# nodes are splits, the rest are leaves whose points sit in pts[leaf_start[j]:leaf_start[j + 1]]
+	# single precision is plenty to pick the closest vert and halves what the search reads,
+	# matched positions still come from the double precision points through index
+	split = np.empty(num_leaves - 1, dtype=np.float32)
+	leaf_start = np.full(num_leaves + 1, n, dtype=np.int64)
+
+	order = np.arange(n)
+	# (start and end of branch in order, node, depth)
+	stack = [(0, n, 0, 0)]
+	while stack:
+		lo, hi, node, depth = stack.pop()
+
+		if node >= num_leaves - 1:
+			leaf_start[node - (num_leaves - 1)] = lo
+			continue
+
+		# split tree based on this axis
+		axis = depth % 3
+		branch = order[lo:hi]
+		mid = (hi - lo) // 2
+		# only the pivot needs to be in place, everything either side just has to be on the right side of it
+		order[lo:hi] = branch[np.argpartition(points[branch, axis], mid)]
+		mid += lo
+
+		split[node] = points[order[mid], axis]
+
+		stack.append((lo, mid, 2 * node + 1, depth + 1))
+		stack.append((mid, hi, 2 * node + 2, depth + 1))
+
+	return points[order].astype(np.float32), split, leaf_start, order
 # end def buildKdTree():
 
 
-def distanceSquare(point1, point2):
-	local_p = point1 - point2
-	return local_p[0] * local_p[0] + local_p[1] * local_p[1] + local_p[2] * local_p[2]
-# end def distanceSquare():
+# deep enough for any tree that fits in memory, a complete tree only ever holds height + 1 pending branches
+MAX_STACK = 128
+
+
+@njit(cache=True)
+def nearestNeighbor(pts, split, leaf_start, in_point):
+	num_splits = len(split)
+	best_d2 = np.inf
+	best = -1
+	qx = in_point[0]
+	qy = in_point[1]
+	qz = in_point[2]
+
+	# pending branches with the squared distance to their splitting plane, checked when popped
+	stack_node = np.empty(MAX_STACK, dtype=np.int64)
+	stack_depth = np.empty(MAX_STACK, dtype=np.int64)
+	stack_bound = np.empty(MAX_STACK, dtype=np.float64)
+	stack_node[0] = 0
+	stack_depth[0] = 0
+	stack_bound[0] = 0.0
+	size = 1
+
+	while size:
+		size -= 1
+		node = stack_node[size]
+		depth = stack_depth[size]
+
+		if stack_bound[size] >= best_d2:
+			continue
+
+		# leaf, scan its bucket
+		if node >= num_splits:
+			leaf = node - num_splits
+			for i in range(leaf_start[leaf], leaf_start[leaf + 1]):
+				dx = qx - pts[i, 0]
+				dy = qy - pts[i, 1]
+				dz = qz - pts[i, 2]
+				d2 = dx * dx + dy * dy + dz * dz
+				if d2 < best_d2:
+					best_d2 = d2
+					best = i
+			continue
+
+		axis = depth % 3
+		plane_d = in_point[axis] - split[node]
+
+		next_branch = 2 * node + 1 + (plane_d >= 0)
+		opposite_branch = 4 * node + 3 - next_branch
+
+		# far side goes on first so the near side is searched first
+		stack_node[size] = opposite_branch
+		stack_depth[size] = depth + 1
+		stack_bound[size] = plane_d * plane_d
+		size += 1
+
+		stack_node[size] = next_branch
+		stack_depth[size] = depth + 1
+		stack_bound[size] = 0.0
+		size += 1
+
+	return best
+# end def nearestNeighbor():
+
 
+@njit(cache=True, parallel=True)
+def queryKdTree(pts, split, leaf_start, index, queries):
+	idxs = np.empty(len(queries), dtype=np.int64)
 
-def closerDistance(pivot, p1, p2):
-	if p1 is None:
-		return p2
+	for i in prange(len(queries)):
+		idxs[i] = index[nearestNeighbor(pts, split, leaf_start, queries[i])]
 
-	if p2 is None:
-		return p1
+	return idxs
+# end def queryKdTree():
 
-	d1 = distanceSquare(pivot, p1)
-	d2 = distanceSquare(pivot, p2)
 
-	if d1 < d2:
-		return p1
-	else:
-		return p2
-# end def closerDistance():
+def closestBruteForce(tree_pts, queries):
+	tree_d2 = (tree_pts * tree_pts).sum(1)
+	idxs = np.empty(len(queries), dtype=np.int64)
 
+	# BLAS already threads the dot product, chunks just cap memory
+	step = max(1, BRUTE_FORCE_CHUNK // len(tree_pts))
+	d2_buffer = np.empty((min(step, len(queries)), len(tree_pts)), dtype=np.float64)
+	for start in range(0, len(queries), step):
+		chunk = queries[start:start + step]
+		# |q - t|^2 = |q|^2 + |t|^2 - 2q.t, |q|^2 is constant per row so doesn't change the argmin.
+		# built in place so only the one matrix is ever live
+		d2 = np.dot(chunk, tree_pts.T, out=d2_buffer[:len(chunk)])
+		d2 *= -2
+		d2 += tree_d2
+		idxs[start:start + step] = d2.argmin(axis=1)
 
-def nearestNeighbor(tree, in_point, depth=0):
-	if tree is None:
-		return None
+	return idxs
+# end def closestBruteForce():
 
-	axis = depth % 3
 
-	if in_point[axis] < tree['point'][axis]:
-		next_branch = tree['negative']
-		opposite_branch = tree['positive']
+def sourceKey(mesh_names, tree_pts):
+	# hashing the raw positions is cheap next to a build and catches any edit to the source verts
+	return tuple(mesh_names), tree_pts.shape, hash(tree_pts.tobytes())
+# end def sourceKey():
+
+
+def sourceTree(tree_pts, mesh_names):
+	key = sourceKey(mesh_names, tree_pts)
+	vert_tree = _TREE_CACHE.get(key)
+	if vert_tree is not None:
+		return vert_tree
+
+	if cKDTree is None:
+		vert_tree = buildKdTree(tree_pts)
 	else:
-		next_branch = tree['positive']
-		opposite_branch = tree['negative']
+		# construction cost outweighs query gains from a balanced tree for a single batch of queries
+		vert_tree = cKDTree(tree_pts, leafsize=16, balanced_tree=False, compact_nodes=False)
 
-	nearest = closerDistance(in_point, nearestNeighbor(next_branch, in_point, depth + 1), tree['point'])
+	# only hold on to one tree, they can be as big as the mesh
+	_TREE_CACHE.clear()
+	_TREE_CACHE[key] = vert_tree
+	return vert_tree
+# end def sourceTree():
 
-	if distanceSquare(in_point, nearest) > (in_point[axis] - tree['point'][axis]) ** 2:
-		nearest = closerDistance(in_point, nearestNeighbor(opposite_branch, in_point, depth + 1), nearest)
 
-	return nearest
-# end def nearestNeighbor():
+def closestIndices(tree_pts, queries, mesh_names):
+	if cKDTree is None and not HAS_NUMBA and len(tree_pts) < BRUTE_FORCE_LIMIT:
+		return closestBruteForce(tree_pts, queries)
+
+	vert_tree = sourceTree(tree_pts, mesh_names)
+
+	if cKDTree is None:
+		pts, split, leaf_start, index = vert_tree
+		return queryKdTree(pts, split, leaf_start, index, queries.astype(np.float32))
+
+	dists, idxs = vert_tree.query(queries, k=1, workers=-1)
+	return idxs
+# end def closestIndices():
 
 
 def maya_useNewAPI():
@@ -89,13 +259,16 @@ class vertMatch(om2.MPxCommand):
 	kPluginCmdName = "vertMatch"
 	mirrorFlag = '-m'
 	mirrorFlagLong = '-mirror'
+	noSourceWarning = 'No source verts, select verts to match to or use -mirror.'
 
 	def __init__(self):
 		om2.MPxCommand.__init__(self)
 
+		self.selection = None
 		self.iter_components = None
 		self.mirror = 0
-		self.initialState = []
+		self.initialIndices = []
+		self.initialState = np.empty((0, 3), dtype=np.float64)
 	# end def __init__():
 
 	@staticmethod
@@ -113,8 +286,8 @@ class vertMatch(om2.MPxCommand):
 	# end def createSyntax():
 
 	def doIt(self, args):
-		sel = om2.MGlobal.getActiveSelectionList()
-		self.iter_components = om2.MItSelectionList(sel)
+		self.selection = om2.MGlobal.getActiveSelectionList()
+		self.iter_components = om2.MItSelectionList(self.selection)
 
 		argDb = om2.MArgDatabase(self.syntax(), args)
 
@@ -129,67 +302,80 @@ class vertMatch(om2.MPxCommand):
 	# end def isUndoable():
 
 	def undoIt(self):
+		if not self.initialIndices:
+			return
+
 		self.iter_components.reset()
 		MDagMesh, MObComponent = self.iter_components.getComponent()
-		iter_undo = om2.MItMeshVertex(MDagMesh, MObComponent)
+		fn_undo = om2.MFnMesh(MDagMesh)
 
-		i = 0
-		while not iter_undo.isDone():
-			iter_undo.setPosition(self.initialState[i], om2.MSpace.kWorld)
+		kWorld = om2.MSpace.kWorld
+		MPoint = om2.MPoint
+		undo_pts = fn_undo.getPoints(kWorld)
+		for vert_id, point in zip(self.initialIndices, self.initialState.tolist()):
+			undo_pts[vert_id] = MPoint(*point)
 
-			i += 1
-			iter_undo.next()
+		fn_undo.setPoints(undo_pts, kWorld)
 	# end def undoIt():
 
 	def redoIt(self):
-		first_iteration = True
+		# first selection is the input points, anything after it is what they get matched to
+		if self.selection.length() < (1 if self.mirror else 2):
+			om2.MGlobal.displayWarning(vertMatch.noSourceWarning)
+			return
+
+		kWorld = om2.MSpace.kWorld
+		self.iter_components.reset()
+		MDagMesh, MObComponent = self.iter_components.getComponent()
+		fn_input = om2.MFnMesh(MDagMesh)
+		new_pts = fn_input.getPoints(kWorld)
+
+		input_idx = vertexIndices(MObComponent, len(new_pts))
+		queries = selectedPoints(new_pts, input_idx)
+
 		tree_ls = []
-		while not self.iter_components.isDone():
-			# First iteration is input points, so skip unless mirror flag is True then reverse the x-axis.
-			if first_iteration:
-				if self.mirror:
-					MDagMesh, MObComponent = self.iter_components.getComponent()
-					iter_mirror = om2.MItMeshVertex(MDagMesh, MObComponent)
-
-					while not iter_mirror.isDone():
-						point = iter_mirror.position(om2.MSpace.kWorld)
-						point[0] *= -1
-						tree_ls.append(point)
-						iter_mirror.next()
-
-				self.iter_components.next()
-				first_iteration = False
-				continue
+		mesh_names = []
 
-			MDagMesh, MObComponent = self.iter_components.getComponent()
-			iter_vert = om2.MItMeshVertex(MDagMesh, MObComponent)
+		# input points are only part of the tree when mirroring, then reverse the x-axis.
+		if self.mirror:
+			mirror_pts = queries.copy()
+			mirror_pts[:, 0] *= -1
+			tree_ls.append(mirror_pts)
+			mesh_names.append(MDagMesh.fullPathName())
 
-			while not iter_vert.isDone():
-				tree_ls.append(iter_vert.position(om2.MSpace.kWorld))
-				iter_vert.next()
+		self.iter_components.next()
+		while not self.iter_components.isDone():
+			MDagMesh, MObComponent = self.iter_components.getComponent()
+			tree_ls.append(vertexPositions(MDagMesh, MObComponent))
+			mesh_names.append(MDagMesh.fullPathName())
 
 			self.iter_components.next()
 
-		vert_tree = buildKdTree(tree_ls)
+		tree_pts = np.concatenate(tree_ls)
+		if not len(tree_pts):
+			om2.MGlobal.displayWarning(vertMatch.noSourceWarning)
+			return
 
-		self.iter_components.reset()
-		MDagMesh, MObComponent = self.iter_components.getComponent()
-		iter_input = om2.MItMeshVertex(MDagMesh, MObComponent)
+		# save for undo
+		self.initialIndices = input_idx
+		self.initialState = queries
 
-		while not iter_input.isDone():
-			input_point = iter_input.position(om2.MSpace.kWorld)
-			# save for undo
-			self.initialState.append(input_point)
+		# when mirroring only the negative x side gets matched, the rest is left as is
+		if self.mirror:
+			match = queries[:, 0] < 0
+			queries = queries[match]
+			match_idx = np.asarray(input_idx)[match].tolist()
+		else:
+			match_idx = input_idx
 
-			if self.mirror:
-				if input_point[0] >= 0:
-					iter_input.next()
-					continue
+		# plain float lists so the only per vertex allocation is the final MPoint
+		closest = tree_pts[closestIndices(tree_pts, queries, mesh_names)].tolist()
 
-			closest = nearestNeighbor(vert_tree, input_point)
-			iter_input.setPosition(closest, om2.MSpace.kWorld)
+		MPoint = om2.MPoint
+		for vert_id, point in zip(match_idx, closest):
+			new_pts[vert_id] = MPoint(*point)
 
-			iter_input.next()
+		fn_input.setPoints(new_pts, kWorld)
 	# end def redoIt():
 
 